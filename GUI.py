@@ -10,6 +10,7 @@ Copyright and Usage Information
 This file is Copyright (c) 2023 Ethan Chan, Ernest Yuen, Alyssa Lu, and Kelsie Fung.
 """
 
+import os
 from tkinter import *
 from tkinter import ttk
 from urllib.request import urlopen
@@ -17,6 +18,9 @@ from PIL import ImageTk
 import book_selection as rb
 import similar_books_graph as bg
 
+# where the client's session is saved to, and resumed from
+SESSION_FILE = 'session.ckpt'
+
 
 class BookSetup:
     """A class that handles the setup and first inputs of the application: getting the genres the client is interested
@@ -51,6 +55,12 @@ class BookSetup:
         # position the button
         self.init_widgets[0].grid(column=3, row=2, sticky=W)
 
+        # if the client saved a session before, let them pick it back up instead
+        if os.path.exists(SESSION_FILE):
+            resume_btn = ttk.Button(mainframe, text='Resume Last Session', command=self.resume_booknetwork)
+            resume_btn.grid(column=3, row=3, sticky=W)
+            self.init_widgets.append(resume_btn)
+
         # pad every widget within the frame so everything is not squished
         for child in mainframe.winfo_children():
             child.grid_configure(padx=5, pady=5)
@@ -102,6 +112,20 @@ class BookSetup:
         run_book_network = rb.RunBookNetwork(chosen_genres)
         BookGUI(self.root, run_book_network)
 
+    def resume_booknetwork(self) -> None:
+        """This function is called once the user clicks the "Resume Last Session" button, and restores the
+        RunBookNetwork instance of the last saved session to be used to recommend books to the user.
+        """
+        # clear the initial setup widgets
+        for genre in self.genre_widgets:
+            self.genre_widgets[genre][0].destroy()
+        for init_widget in self.init_widgets:
+            init_widget.destroy()
+
+        run_book_network = rb.resume_session(SESSION_FILE)
+        print(f'Resumed a session with the genres: {run_book_network.genres}')
+        BookGUI(self.root, run_book_network)
+
 
 class BookGUI:
     """The class running the main GUI interactions between the client and the
@@ -139,8 +163,9 @@ class BookGUI:
         self.rbn = rbn
         self.displayed_books = []
         self.preferences = []
-        self.client_disliked = []
-        self.client_liked = []
+        # if the session was resumed, the client will already have liked/disliked some books
+        self.client_disliked = [self.rbn.all_books[b_id]['title'] for b_id in self.rbn.disliked_books]
+        self.client_liked = [self.rbn.all_books[b_id]['title'] for b_id in self.rbn.liked_books]
         self.book_labels = []
 
         # define the main frame, 3px padding on left and right, 12px on top and bottom
@@ -168,24 +193,36 @@ class BookGUI:
         select_lbl = ttk.Label(self.mainframe, text='Select a Method of Recommending Books:')
         select_lbl.grid(column=2, row=0)
 
-        # create the input for the book selection method (random, popularity, rating) using radio button widgets
+        # create the input for the book selection method (random, popularity, rating, similar) using radio button
+        # widgets
         self.selection_type = StringVar(value="no_choice")
 
+        # the radio buttons get their own frame spanning the 3 book columns, so that there can be more of them than
+        # there are columns (column 4 is for the liked books)
+        selection_frame = ttk.Frame(self.mainframe)
+        selection_frame.grid(column=1, row=1, columnspan=3)
+
         # save the input widgets to a dictionary
         radio_buttons = {}
-        selection_types = ['Random', 'Rating', 'Popularity']
-        i = 1
+        selection_types = ['Random', 'Rating', 'Popularity', 'Similar']
+        i = 0
         # create one radio button per selection type
         for selection in selection_types:
-            radio_buttons[selection.lower()] = ttk.Radiobutton(self.mainframe, text=selection,
+            radio_buttons[selection.lower()] = ttk.Radiobutton(selection_frame, text=selection,
                                                                variable=self.selection_type, value=selection.lower())
-            radio_buttons[selection.lower()].grid(column=i, row=1)
+            radio_buttons[selection.lower()].grid(column=i, row=0, padx=10)
             i += 1
 
         # finally, create the button that can be used to start recommending books
         recommend_btn = ttk.Button(self.mainframe, text='Recommend!', command=self.recommend)
         recommend_btn.grid(column=2, row=2, pady=3)
 
+        # and the button that saves the session, so the client can come back to it later
+        save_btn = ttk.Button(self.mainframe, text='Save Session', command=self.save_session)
+        save_btn.grid(column=3, row=2, pady=3)
+
+        self.render_books()
+
     def clear_books(self) -> None:
         """Clears the books which are displayed by the "recommend" function.
         """
@@ -228,7 +265,7 @@ class BookGUI:
             elif self.preferences[i].get() == 'Dislike':
                 disliked.append(self.displayed_books[i][0])
 
-        dissimilar_users = self.rbn.book_network.prune(disliked)
+        dissimilar_users = self.rbn.record_feedback(liked, disliked)
         print(f'Dissimilar Users: {dissimilar_users}')
 
         liked_names = [self.rbn.all_books[b_id]['title'] for b_id in liked]
@@ -243,6 +280,13 @@ class BookGUI:
         self.clear_books()
         self.render_books()
 
+    def save_session(self) -> None:
+        """Saves the client's progress so far, which can be resumed from the setup screen the next time the
+        application is opened.
+        """
+        self.rbn.save_session(SESSION_FILE)
+        print(f'Saved the session to {SESSION_FILE}')
+
     def recommend(self) -> None:
         """Handles the recommending of the books, by using the RunBookNetwork instance in concert with GUI methods.
         """
@@ -313,6 +357,9 @@ class BookGUI:
             self.displayed_books[2][1].append(update_preferences)
 
 
-root = Tk()
-BookSetup(root)
-root.mainloop()
+# the genres may be loaded in separate processes, which (depending on the platform) import this module again, so the
+# application must only be started when this module is run directly
+if __name__ == '__main__':
+    root = Tk()
+    BookSetup(root)
+    root.mainloop()
@@ -0,0 +1,385 @@
+"""CSC111 Course Project:  Books On Books On Books
+
+===============================
+
+This module contains a collection of Python classes and functions for building, saving and reading a precomputed
+index of co-rated books: for each book, the K other books most often rated well by the same users. The index is built
+offline from a users_read dataset, and then read through a memory-mapped file so that "more like this" recommendations
+do not need to walk the BookNetwork.
+
+Copyright and Usage Information
+===============================
+
+This file is Copyright (c) 2023 Ethan Chan, Ernest Yuen, Alyssa Lu, and Kelsie Fung.
+"""
+from __future__ import annotations
+from array import array
+import heapq
+import json
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import similar_books_graph as bg
+
+# the first bytes of every index file, used to make sure we are not reading some other file
+INDEX_MAGIC = b'BKIX'
+# magic, number of books, number of books with their own neighbour list (they come first), number of
+# (neighbour, score) entries, size of the encoded book ID table in bytes
+HEADER_FORMAT = '4sIIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# once the updated neighbour lists of an index make up more than this fraction of it, they are folded into the index
+UPDATES_COMPACT_RATIO = 0.25
+
+# type alias for clearer type annotations: a mapping of each book to its (neighbour, score) pairs, highest score first
+NeighboursDict = dict[bg.BookID, list[tuple[bg.BookID, float]]]
+
+
+def get_good_books(users_read: bg.UsersReadDict) -> dict[bg.BookID, set[bg.UserID]]:
+    """Given a users_read dictionary, return a mapping of each book to the set of users who gave it a good rating.
+    """
+    good_books = {}
+    for u_id in users_read:
+        for book_id in users_read[u_id]:
+            if users_read[u_id][book_id] >= bg.GOOD_RATING:
+                if book_id not in good_books:
+                    good_books[book_id] = {u_id}
+                else:
+                    good_books[book_id].add(u_id)
+
+    return good_books
+
+
+def get_book_neighbours(book_id: bg.BookID, users_read: bg.UsersReadDict,
+                        good_books: dict[bg.BookID, set[bg.UserID]], k: int = 20,
+                        normalize: bool = False) -> list[tuple[bg.BookID, float]]:
+    """Return the k books most often rated well together with book_id, along with their scores, highest first.
+
+    A score is the number of users who rated both books well. If normalize is True, that count is divided by
+    sqrt(n_1 * n_2), where n_1 and n_2 are the number of users who rated each book well (the cosine similarity), so that
+    books that are simply popular do not end up in every neighbour list.
+
+    Preconditions:
+        - book_id in good_books
+        - k >= 0
+    """
+    counts = {}
+    # only the users who liked this book can contribute to its co-occurrence counts
+    for u_id in good_books[book_id]:
+        for other_id in users_read[u_id]:
+            if other_id != book_id and users_read[u_id][other_id] >= bg.GOOD_RATING:
+                counts[other_id] = counts.get(other_id, 0) + 1
+
+    n_raters = {other_id: len(good_books[other_id]) for other_id in counts}
+    return get_top_neighbours(counts, len(good_books[book_id]), n_raters, k, normalize)
+
+
+def get_top_neighbours(counts: dict[bg.BookID, int], n: int, n_raters: dict[bg.BookID, int], k: int,
+                       normalize: bool) -> list[tuple[bg.BookID, float]]:
+    """Given the co-occurrence counts of a book with n good ratings, and the number of good ratings of each of the
+    books it was counted with, return its k highest scoring neighbours. See get_book_neighbours for the scores.
+    """
+    if normalize:
+        scores = {other_id: counts[other_id] / math.sqrt(n * n_raters[other_id]) for other_id in counts}
+    else:
+        scores = counts
+
+    return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def build_index(users_read: bg.UsersReadDict, k: int = 20, normalize: bool = False) -> NeighboursDict:
+    """Given a users_read dictionary, compute the top-k co-rated books of every book that has at least one good rating.
+    See get_book_neighbours for how the scores are computed.
+
+    >>> users_read = {'u1': {'a': 5, 'b': 4, 'c': 1}, 'u2': {'a': 4, 'b': 5, 'c': 5}}
+    >>> build_index(users_read)['a']
+    [('b', 2), ('c', 1)]
+    """
+    good_books = get_good_books(users_read)
+    return {book_id: get_book_neighbours(book_id, users_read, good_books, k, normalize) for book_id in good_books}
+
+
+def save_index(neighbours: NeighboursDict, file_save_name: str) -> None:
+    """Write the given neighbour lists to file_save_name in the compact binary format read by BookIndex.
+
+    The file holds a header, then a table of offsets (one per book, plus one) into the neighbour and score arrays, then
+    the neighbour arrays themselves (as positions in the book ID table), and finally the newline-separated book IDs.
+    The books in neighbours come first in the book ID table, followed by the books that are only someone's neighbour.
+    Numbers are stored in the machine's native byte order, so an index file is meant to be built where it is used.
+    """
+    # every book that appears anywhere in the index gets a position in the book ID table
+    book_ids = list(neighbours)
+    positions = {book_id: i for i, book_id in enumerate(book_ids)}
+    for book_id in neighbours:
+        for other_id, _ in neighbours[book_id]:
+            if other_id not in positions:
+                positions[other_id] = len(book_ids)
+                book_ids.append(other_id)
+
+    offsets = array('I', [0])
+    neighbour_positions = array('I')
+    scores = array('f')
+    # books that were only ever neighbours still get an (empty) neighbour list, so that offsets covers every book
+    for book_id in book_ids:
+        for other_id, score in neighbours.get(book_id, []):
+            neighbour_positions.append(positions[other_id])
+            scores.append(score)
+        offsets.append(len(neighbour_positions))
+
+    id_table = '\n'.join(book_ids).encode('utf-8')
+
+    with open(file_save_name, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, len(book_ids), len(neighbours), len(neighbour_positions),
+                            len(id_table)))
+        offsets.tofile(f)
+        neighbour_positions.tofile(f)
+        scores.tofile(f)
+        f.write(id_table)
+
+
+def build_index_file(users_read_file: str, file_save_name: str, k: int = 20, normalize: bool = False) -> None:
+    """Given a filename of a cleaned users_read dataset, build its co-rated books index and save it to file_save_name.
+    This is the offline job that should be run once per genre, after the users_read data has been generated.
+
+    Alongside the index, a database of who rated each book well is saved (see save_raters), so that the index can later
+    be brought up to date with update_index_file without reading the whole users_read dataset again.
+    """
+    # imported here, as data_gen itself imports this module
+    import data_gen
+
+    users_read = data_gen.get_cleaned_data(users_read_file)
+    save_index(build_index(users_read, k, normalize), file_save_name)
+    # this also drops any updates to the old index, as they are already part of the new one
+    save_raters(users_read, f'{file_save_name}.raters')
+
+
+def save_raters(users_read: bg.UsersReadDict, file_save_name: str) -> None:
+    """Save every good rating in users_read to a new SQLite database with the given filename, with a table
+    good(user_id, book_id) that can be looked up both by user and by book.
+
+    The database also holds the neighbour lists updated by update_index_file, in a table updated(book_id, neighbours),
+    along with their number in the table meta.
+    """
+    if os.path.exists(file_save_name):
+        os.remove(file_save_name)
+
+    conn = sqlite3.connect(file_save_name)
+    with conn:
+        conn.execute('CREATE TABLE good (user_id TEXT, book_id TEXT, PRIMARY KEY (user_id, book_id)) WITHOUT ROWID')
+        conn.execute('CREATE INDEX good_book ON good (book_id, user_id)')
+        conn.execute('CREATE TABLE updated (book_id TEXT PRIMARY KEY, neighbours TEXT) WITHOUT ROWID')
+        conn.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value INTEGER) WITHOUT ROWID')
+        conn.execute("INSERT INTO meta VALUES ('n_updated', 0)")
+        conn.executemany('INSERT INTO good VALUES (?, ?)',
+                         ((u_id, book_id) for u_id in users_read for book_id in users_read[u_id]
+                          if users_read[u_id][book_id] >= bg.GOOD_RATING))
+    conn.close()
+
+
+def update_raters(conn: sqlite3.Connection, changed: bg.UsersReadDict) -> set[bg.BookID]:
+    """Apply the changed ratings (mapping each user to only their new ratings) to the good ratings database conn, and
+    return the set of books whose co-occurrence counts could have changed because of them: the books that were rated in
+    changed, and every book the users in changed now rate well.
+    """
+    affected = set()
+    for u_id in changed:
+        for book_id in changed[u_id]:
+            affected.add(book_id)
+            if changed[u_id][book_id] >= bg.GOOD_RATING:
+                conn.execute('INSERT OR IGNORE INTO good VALUES (?, ?)', (u_id, book_id))
+            else:  # the user might have rated it well before
+                conn.execute('DELETE FROM good WHERE user_id = ? AND book_id = ?', (u_id, book_id))
+
+        affected.update(row[0] for row in conn.execute('SELECT book_id FROM good WHERE user_id = ?', (u_id,)))
+
+    return affected
+
+
+def get_book_neighbours_from_raters(conn: sqlite3.Connection, book_id: bg.BookID, k: int = 20,
+                                    normalize: bool = False) -> list[tuple[bg.BookID, float]]:
+    """Return the same neighbours as get_book_neighbours, but computed from the good ratings database conn, so that only
+    the ratings of the users who rated book_id well are read.
+    """
+    counts = {}
+    n_raters = {}
+    rows = conn.execute('SELECT other.book_id, COUNT(*), '
+                        '(SELECT COUNT(*) FROM good WHERE good.book_id = other.book_id) '
+                        'FROM good AS this JOIN good AS other ON this.user_id = other.user_id '
+                        'WHERE this.book_id = ? AND other.book_id != ? GROUP BY other.book_id', (book_id, book_id))
+    for other_id, count, n_other in rows:
+        counts[other_id] = count
+        n_raters[other_id] = n_other
+
+    n = conn.execute('SELECT COUNT(*) FROM good WHERE book_id = ?', (book_id,)).fetchone()[0]
+    return get_top_neighbours(counts, n, n_raters, k, normalize)
+
+
+def update_index_file(index_file: str, changed: bg.UsersReadDict, k: int = 20, normalize: bool = False) -> None:
+    """Given the filename of an existing index (built with build_index_file), and the ratings that changed since it was
+    built (mapping each user to only their new ratings), bring the index up to date.
+
+    Only the neighbour lists of the books whose co-occurrence counts could have changed are recomputed (see
+    update_raters), using the index's good ratings database. They are saved to that same database, one row per book,
+    and BookIndex reads them in place of the ones in the index file. So this only reads and writes the ratings and
+    neighbour lists of the affected books, apart from the occasional compaction: once the updated neighbour lists make
+    up more than UPDATES_COMPACT_RATIO of the index, they are folded into it (see compact_index_file).
+
+    With normalize, the scores that unaffected books give to affected books can be slightly out of date (as the number
+    of good ratings of the affected books changed), until the index is rebuilt from scratch with build_index_file.
+
+    Preconditions:
+        - k and normalize are the same as what the index was built with
+    """
+    conn = sqlite3.connect(f'{index_file}.raters')
+    with conn:
+        affected = update_raters(conn, changed)
+
+        n_updated = conn.execute("SELECT value FROM meta WHERE name = 'n_updated'").fetchone()[0]
+        for book_id in affected:
+            if conn.execute('SELECT 1 FROM updated WHERE book_id = ?', (book_id,)).fetchone() is None:
+                n_updated += 1
+            neighbours = get_book_neighbours_from_raters(conn, book_id, k, normalize)
+            conn.execute('INSERT OR REPLACE INTO updated VALUES (?, ?)', (book_id, json.dumps(neighbours)))
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'n_updated'", (n_updated,))
+    conn.close()
+
+    # only the header is needed to know how big the index is
+    with open(index_file, 'rb') as f:
+        n_rows = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))[2]
+    if n_updated > UPDATES_COMPACT_RATIO * n_rows:
+        compact_index_file(index_file)
+
+
+def compact_index_file(index_file: str) -> None:
+    """Fold the updated neighbour lists saved by update_index_file back into the index file itself.
+    """
+    index = BookIndex(index_file)
+    book_ids = index.book_ids[:index.n_rows]
+    if index.updates is not None:
+        book_ids += [row[0] for row in index.updates.execute('SELECT book_id FROM updated')]
+    neighbours = {book_id: index.get_neighbours(book_id) for book_id in book_ids}
+    index.close()
+
+    save_index(neighbours, index_file)
+
+    conn = sqlite3.connect(f'{index_file}.raters')
+    with conn:
+        conn.execute('DELETE FROM updated')
+        conn.execute("UPDATE meta SET value = 0 WHERE name = 'n_updated'")
+    conn.close()
+
+
+class BookIndex:
+    """A read-only, memory-mapped view of an index file written by save_index.
+
+    Only the book ID table is decoded when the file is opened; the neighbour lists themselves are read straight from
+    the mapped file whenever they are asked for. If the index has been updated by update_index_file, its good ratings
+    database is opened as well, and the updated neighbour lists in it take the place of the ones in the index file.
+
+    Instance Attributes:
+    - book_ids:
+        The book IDs in the index file, in the order they are stored in the file
+    - positions:
+        A mapping of each book ID in the index file to its position in book_ids
+    - n_rows:
+        The number of books in the index file with their own neighbour list (they are the first ones in book_ids)
+    - updates:
+        The database holding the updated neighbour lists, or None if there are none
+    """
+    book_ids: list[bg.BookID]
+    positions: dict[bg.BookID, int]
+    n_rows: int
+    updates: sqlite3.Connection | None
+    _file: mmap.mmap
+    _offsets: memoryview
+    _neighbours: memoryview
+    _scores: memoryview
+
+    def __init__(self, filename: str) -> None:
+        """Open the index file with the given filename, along with its updates if it has any.
+        """
+        with open(filename, 'rb') as f:
+            self._file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_books, self.n_rows, n_entries, id_table_size = struct.unpack_from(HEADER_FORMAT, self._file)
+        if magic != INDEX_MAGIC:
+            self._file.close()
+            raise ValueError(f'{filename} is not a book index file')
+
+        # each section directly follows the previous one, and every number takes 4 bytes
+        view = memoryview(self._file)
+        start = HEADER_SIZE
+        self._offsets = view[start:start + 4 * (n_books + 1)].cast('I')
+        start += 4 * (n_books + 1)
+        self._neighbours = view[start:start + 4 * n_entries].cast('I')
+        start += 4 * n_entries
+        self._scores = view[start:start + 4 * n_entries].cast('f')
+        start += 4 * n_entries
+
+        id_table = bytes(view[start:start + id_table_size]).decode('utf-8')
+        self.book_ids = id_table.split('\n') if n_books > 0 else []
+        self.positions = {book_id: i for i, book_id in enumerate(self.book_ids)}
+
+        self.updates = None
+        if os.path.exists(f'{filename}.raters'):
+            conn = sqlite3.connect(f'{filename}.raters')
+            if conn.execute("SELECT value FROM meta WHERE name = 'n_updated'").fetchone()[0] > 0:
+                self.updates = conn
+            else:
+                conn.close()
+
+    def __contains__(self, book_id: bg.BookID) -> bool:
+        return book_id in self.positions or self.get_updated_neighbours(book_id) is not None
+
+    def get_updated_neighbours(self, book_id: bg.BookID) -> list[tuple[bg.BookID, float]] | None:
+        """Return the updated (neighbour, score) pairs of the given book, or None if it has not been updated.
+        """
+        if self.updates is None:
+            return None
+
+        row = self.updates.execute('SELECT neighbours FROM updated WHERE book_id = ?', (book_id,)).fetchone()
+        if row is None:
+            return None
+        return [(other_id, score) for other_id, score in json.loads(row[0])]
+
+    def get_neighbours(self, book_id: bg.BookID) -> list[tuple[bg.BookID, float]]:
+        """Return the (neighbour, score) pairs of the given book, highest score first. Books that are not in the index
+        have no neighbours.
+        """
+        # an updated book has its own neighbour list in the updates, even if it is empty
+        updated = self.get_updated_neighbours(book_id)
+        if updated is not None:
+            return updated
+
+        if book_id not in self.positions:
+            return []
+
+        i = self.positions[book_id]
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return [(self.book_ids[self._neighbours[j]], self._scores[j]) for j in range(start, end)]
+
+    def close(self) -> None:
+        """Release the memory-mapped file (and the updates database). The index cannot be read from after this.
+        """
+        if self.updates is not None:
+            self.updates.close()
+        self._offsets.release()
+        self._neighbours.release()
+        self._scores.release()
+        self._file.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
+
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['__future__', 'array', 'heapq', 'json', 'math', 'mmap', 'os', 'sqlite3', 'struct',
+                          'similar_books_graph', 'data_gen'],
+        'allowed-io': ['save_index', 'build_index_file', 'update_index_file', 'BookIndex.__init__'],
+        'max-line-length': 120,
+        'disable': ['E9992', 'E9997']
+    })
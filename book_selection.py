@@ -10,8 +10,27 @@ Copyright and Usage Information
 This file is Copyright (c) 2023 Ethan Chan, Ernest Yuen, Alyssa Lu, and Kelsie Fung.
 """
 
+import os
+import pickle
+import struct
+import tempfile
+import zlib
 import similar_books_graph as bg
 import data_gen
+import book_index as bi
+
+# the first bytes of every session checkpoint file, used to make sure we are not reading some other file
+SESSION_MAGIC = b'BKSS'
+# magic, then the size in bytes of each of the sections that follow: the genres, the (compressed) removed users, the
+# used books, the liked books, and the disliked books
+SESSION_HEADER_FORMAT = '<4sIIIII'
+# the folder the base networks of resumed sessions are cached in
+BASE_CACHE_FOLDER = 'session_cache'
+# the version of the cached base networks' format, to be increased whenever BookNetwork (or how it is pickled) changes,
+# so that caches written by older code are rebuilt instead of being loaded
+BASE_CACHE_VERSION = 1
+# the compaction policy of the BookNetwork of every RunBookNetwork (see BookNetwork.__init__)
+NETWORK_POLICY = {'min_degree': 1, 'max_books': None, 'compact_every': 1}
 
 
 class RunBookNetwork:
@@ -26,24 +45,62 @@ class RunBookNetwork:
     - users_read:
         A mapping of each user to the books they have read, and their respective ratings, used to initialise the
         BookNetwork instance
+    - indexes:
+        The precomputed co-rated books indexes (see book_index.py) of each of the given genres that has one
+    - genres:
+        The genres the books (and users) were taken from
+    - user_list:
+        Every user the BookNetwork was initialised with, in order
+    - liked_books:
+        The IDs of the books that the client has liked so far, used by the 'similar' recommending method
+    - disliked_books:
+        The IDs of the books that the client has disliked so far
     """
     all_books: data_gen.AllBooksDict
     book_network: bg.BookNetwork
     users_read: bg.UsersReadDict
+    indexes: list[bi.BookIndex]
+    genres: list[str]
+    user_list: list[bg.UserID]
+    liked_books: list[bg.BookID]
+    disliked_books: list[bg.BookID]
 
-    def __init__(self, genres: list[str]) -> None:
+    def __init__(self, genres: list[str], data: tuple[bg.UsersReadDict, data_gen.AllBooksDict] | None = None,
+                 indexes: list[bi.BookIndex] | None = None, book_network: bg.BookNetwork | None = None) -> None:
         """Initialise a RunBookNetwork, which then initialises a BookNetwork with books from the given genres.
         Additionally, store the all_books and users_read dict objects relevant to the BookNetwork.
 
+        If the users_read and all_books data (as returned by data_gen.get_genres), or the co-rated books indexes of
+        the genres were already loaded, they can be given as data and indexes to avoid loading them again. They are
+        only read from, so they can be shared between many RunBookNetwork instances. Likewise, an already built
+        BookNetwork of every user in data can be given as book_network, and it is used instead of building a new one.
+
         Preconditions:
             - all(genre in ['comics_graphic', 'fantasy_paranormal', 'mystery_thriller_crime',
                   'romance', 'young_adult'] for genre in genres)
+            - book_network is None or data is not None
         """
-        self.users_read, self.all_books = data_gen.get_genres(genres)
+        self.genres = genres
+        if data is None:
+            self.users_read, self.all_books = data_gen.get_genres(genres)
+        else:
+            self.users_read, self.all_books = data
 
-        user_list = list(self.users_read.keys())
+        self.user_list = list(self.users_read.keys())
 
-        self.book_network = bg.BookNetwork(user_list, self.users_read)
+        if book_network is None:
+            self.book_network = bg.BookNetwork(self.user_list, self.users_read, **NETWORK_POLICY)
+        else:
+            self.book_network = book_network
+
+        # the indexes are built offline with book_index.build_index_file, so a genre might not have one yet
+        if indexes is None:
+            self.indexes = [bi.BookIndex(f'book_index/{genre}.bin') for genre in genres
+                            if os.path.exists(f'book_index/{genre}.bin')]
+        else:
+            self.indexes = indexes
+        self.liked_books = []
+        self.disliked_books = []
 
     def rating_metric(self, book: bg.Node) -> float:
         """This is a function that may be passed to the get_books_by_statistic() method , that calculates the rating of
@@ -68,15 +125,193 @@ class RunBookNetwork:
 
         return (w * m + n * book.rating) / (w + n)
 
+    def get_books_by_similarity(self, n: int = 3) -> list[bg.BookID]:
+        """Select the n books that are most often rated well together with the books the client liked, according to
+        the precomputed co-rated books indexes, and return a list of them.
+
+        The neighbour lists of every liked book are combined by adding up their scores, so a book that is similar to
+        several of the liked books ranks higher. Only books still in the network that have not been recommended yet can
+        be chosen. If fewer than n books are similar to the liked books (e.g. the client has not liked any books yet),
+        the rest are random books.
+
+        >>> import tempfile
+        >>> users_read = {'u1': {'a': 5, 'b': 4}, 'u2': {'a': 1, 'c': 3}, 'u3': {'d': 2, 'e': 3}}
+        >>> index_file = tempfile.mkdtemp() + '/index.bin'
+        >>> bi.save_index(bi.build_index(users_read), index_file)
+        >>> rbn = RunBookNetwork([], (users_read, {}), [bi.BookIndex(index_file)])
+        >>> rbn.liked_books.append('a')
+        >>> books = rbn.get_books_by_similarity()
+        >>> books[0]
+        'b'
+        >>> len(set(books))
+        3
+        """
+        scores = {}
+        for b_id in self.liked_books:
+            for index in self.indexes:
+                for other_id, score in index.get_neighbours(b_id):
+                    if other_id in self.book_network.books and other_id not in self.book_network.used:
+                        scores[other_id] = scores.get(other_id, 0) + score
+
+        recommended = sorted(scores, key=lambda b_id: scores[b_id], reverse=True)[:n]
+        self.book_network.used.update(recommended)
+
+        # the GUI always expects n books, so fill in the rest with random ones (which are never already used ones)
+        if len(recommended) < n:
+            for b_id in self.book_network.get_books_by_random(n - len(recommended)):
+                # when few books are left, get_books_by_random returns all of them, so stop once there are n
+                if b_id not in recommended and len(recommended) < n:
+                    recommended.append(b_id)
+
+        return recommended
+
     def get_recommended_books(self, method: str) -> list[bg.BookID]:
-        """Get the recommended books from the book network given a certain method (random, popularity, or rating)
+        """Get the recommended books from the book network given a certain method (random, popularity, rating, or
+        similar)
 
         Preconditions:
-        - method.lower() in ['rating', 'popularity', 'random']
+        - method.lower() in ['rating', 'popularity', 'random', 'similar']
         """
         if method == 'rating':
             return self.book_network.get_books_by_statistic(self.rating_metric)
         elif method == 'popularity':
             return self.book_network.get_books_by_statistic(lambda book: len(book.connected))
+        elif method == 'similar':
+            return self.get_books_by_similarity()
         else:
             return self.book_network.get_books_by_random()
+
+    def record_feedback(self, liked: list[bg.BookID], disliked: list[bg.BookID]) -> list[bg.UserID]:
+        """Record the books the client liked and disliked in one round of recommendations, and prune the users who
+        liked the disliked books from the network. Return the list of those "dissimilar" users.
+        """
+        self.liked_books.extend(liked)
+        self.disliked_books.extend(disliked)
+        return self.book_network.prune(disliked)
+
+    def save_session(self, filename: str) -> None:
+        """Save the progress of the client's session to a checkpoint file with the given filename, so it can be picked
+        up again later with resume_session.
+
+        Rather than the network itself, the checkpoint holds what changed since it was initialised: the IDs of the users
+        that were removed (compressed), the books that were already recommended, and the books the client liked and
+        disliked.
+        """
+        removed = [u_id for u_id in self.user_list if u_id not in self.book_network.users]
+
+        sections = [
+            '\n'.join(self.genres).encode('utf-8'),
+            zlib.compress('\n'.join(removed).encode('utf-8')),
+            '\n'.join(self.book_network.used).encode('utf-8'),
+            '\n'.join(self.liked_books).encode('utf-8'),
+            '\n'.join(self.disliked_books).encode('utf-8')
+        ]
+
+        with open(filename, 'wb') as f:
+            f.write(struct.pack(SESSION_HEADER_FORMAT, SESSION_MAGIC, *[len(section) for section in sections]))
+            for section in sections:
+                f.write(section)
+
+
+def read_session(filename: str) -> tuple[list[str], list[bg.UserID], list[list[bg.BookID]]]:
+    """Read the session checkpoint file with the given filename, and return a tuple containing its genres, its removed
+    users, and its lists of used, liked and disliked books.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    header = struct.unpack_from(SESSION_HEADER_FORMAT, data)
+    if header[0] != SESSION_MAGIC:
+        raise ValueError(f'{filename} is not a session checkpoint file')
+
+    # split the rest of the file into its sections, which directly follow each other
+    sections = []
+    start = struct.calcsize(SESSION_HEADER_FORMAT)
+    for size in header[1:]:
+        sections.append(data[start:start + size])
+        start += size
+    sections[1] = zlib.decompress(sections[1])
+
+    genres, removed, used, liked, disliked = [section.decode('utf-8').split('\n') if len(section) > 0 else []
+                                              for section in sections]
+
+    return (genres, removed, [used, liked, disliked])
+
+
+def get_data_stamp(genres: list[str]) -> list:
+    """Return the size and modification time of every cleaned data file (and its appended updates) of the given
+    genres, which changes whenever their data does, along with the version of the cache format and the network's
+    compaction policy, which change what the cached network looks like for the same data.
+    """
+    stamp = [BASE_CACHE_VERSION, sorted(NETWORK_POLICY.items())]
+    for genre in genres:
+        stamp.extend(data_gen.get_genre_stamp(genre))
+
+    return stamp
+
+
+def load_base_network(genres: list[str]) -> RunBookNetwork:
+    """Return a new RunBookNetwork of the given genres, loading its data and its (unpruned) BookNetwork from the cache
+    in BASE_CACHE_FOLDER instead of building them again, if they were cached since the genres' data last changed.
+    Otherwise (including when the cache cannot be read), the RunBookNetwork is initialised as usual, and then cached
+    for next time.
+    """
+    cache_file = f'{BASE_CACHE_FOLDER}/{"+".join(genres)}.pickle'
+    stamp = get_data_stamp(genres)
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError, ValueError):
+            # a cache left unreadable (e.g. by an older version of this code) is simply rebuilt
+            cached = None
+        if isinstance(cached, tuple) and len(cached) == 4 and cached[0] == stamp:
+            return RunBookNetwork(genres, (cached[1], cached[2]), book_network=cached[3])
+
+    rbn = RunBookNetwork(genres)
+    os.makedirs(BASE_CACHE_FOLDER, exist_ok=True)
+
+    # write to a temporary file first, and then move it into place, so that the cache is never left half-written
+    fd, temp_file = tempfile.mkstemp(dir=BASE_CACHE_FOLDER, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((stamp, rbn.users_read, rbn.all_books, rbn.book_network), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+    return rbn
+
+
+def resume_session(filename: str) -> RunBookNetwork:
+    """Resume the session saved to the checkpoint file with the given filename by save_session.
+
+    The base network of the checkpoint's genres is loaded from its cache (see load_base_network), and then only the
+    session's changes are applied to it: each removed user is disconnected directly (instead of replaying every prune),
+    and the used, liked and disliked books are restored. Users that were added to the data since the checkpoint was
+    saved are kept in the network.
+    """
+    genres, removed, books = read_session(filename)
+
+    rbn = load_base_network(genres)
+
+    for u_id in removed:
+        # users can also be removed when their last book is, so they may already be gone
+        if u_id in rbn.book_network.users:
+            rbn.book_network.disconnect(rbn.book_network.users[u_id])
+
+    # evict the books the removed users left behind, as the session's own compactions would have
+    rbn.book_network.compact()
+
+    rbn.book_network.used.update(books[0])
+    rbn.liked_books.extend(books[1])
+    rbn.disliked_books.extend(books[2])
+
+    return rbn
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
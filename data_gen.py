@@ -10,12 +10,23 @@ Copyright and Usage Information
 
 This file is Copyright (c) 2023 Ethan Chan, Ernest Yuen, Alyssa Lu, and Kelsie Fung.
 """
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any
 import json
+import os
+import pickle
+import tempfile
 import similar_books_graph as bg
+import book_index as bi
 
 AllBooksDict = dict[bg.BookID, dict[str, Any]]
 
+# once the updates appended to a cleaned data file grow past this fraction of the file's size, they are folded into it
+DELTA_COMPACT_RATIO = 0.25
+# the folder the loaded data of each genre is cached in, as a pickle, which is several times faster to load than the
+# cleaned data's JSON files
+GENRE_CACHE_FOLDER = 'genre_cache'
+
 
 def get_users(review_file: str, save_to_file: bool = False, file_save_name: str = '') -> bg.UsersReadDict | None:
     """Given a review dataset, generate a mapping of user ID to all the books they have read. Each book ID itself maps
@@ -76,36 +87,232 @@ def clean_books(books_data_file: str, save_to_file: bool = False, file_save_name
 def get_cleaned_data(filename: str) -> bg.UsersReadDict | AllBooksDict:
     """Given a valid filename representing cleaned users_read data or all_books data, then read that file, and return
     a corresponding dictionary object.
+
+    If new data has been appended to it (by update_users or update_books) since it was last compacted, that data is
+    merged into the returned dictionary as well.
     """
     with open(filename) as f:
         dictionary = json.load(f)
-        return dictionary
+
+    if os.path.exists(f'{filename}.delta'):
+        with open(f'{filename}.delta') as f:
+            # each line holds one update, and later updates overwrite earlier ones
+            for update in f:
+                merge_update(dictionary, json.loads(update))
+
+    return dictionary
+
+
+def merge_update(dictionary: bg.UsersReadDict | AllBooksDict, update: bg.UsersReadDict | AllBooksDict) -> None:
+    """Mutate the given users_read or all_books dictionary by merging update into it, with the values in update taking
+    precedence. For users_read, this means a user's new ratings are added to (or replace) their existing ones.
+
+    >>> users_read = {'u1': {'b1': 5, 'b2': 3}}
+    >>> merge_update(users_read, {'u1': {'b2': 4}, 'u2': {'b1': 1}})
+    >>> users_read
+    {'u1': {'b1': 5, 'b2': 4}, 'u2': {'b1': 1}}
+    """
+    for key in update:
+        if key not in dictionary:
+            dictionary[key] = update[key]
+        else:
+            dictionary[key].update(update[key])
+
+
+def append_update(update: bg.UsersReadDict | AllBooksDict, file_save_name: str) -> None:
+    """Append the given update to the cleaned data file file_save_name, without rewriting the file itself. The update is
+    stored on its own line in a separate '.delta' file, which is read by get_cleaned_data.
+
+    So that reading the file does not keep getting slower, the updates are folded into the file (see
+    compact_cleaned_data) once they grow past DELTA_COMPACT_RATIO of its size. This keeps the cost of each update
+    proportional to its own size, on average.
+    """
+    if len(update) == 0:
+        return
+
+    with open(f'{file_save_name}.delta', 'a') as output_f:
+        output_f.write(json.dumps(update) + '\n')
+
+    if os.path.getsize(f'{file_save_name}.delta') > DELTA_COMPACT_RATIO * os.path.getsize(file_save_name):
+        compact_cleaned_data(file_save_name)
+
+
+def update_users(review_files: list[str], file_save_name: str) -> bg.UsersReadDict:
+    """Given a list of new review datasets (in the same format as the ones given to get_users), merge the reviews into
+    the existing cleaned users_read data at file_save_name, and return every rating in the new review datasets (some of
+    which may be the same as the existing ones, as the existing data is not read).
+
+    Only the new review files are read: the cleaned data file is left as is, and the new ratings are appended to it (see
+    append_update). When a user rated the same book more than once, the latest rating wins, where the review files are
+    taken to be in chronological order.
+    """
+    new_users = {}
+    for review_file in review_files:
+        merge_update(new_users, get_users(review_file))
+
+    append_update(new_users, file_save_name)
+    return new_users
+
+
+def update_books(books_data_files: list[str], file_save_name: str) -> AllBooksDict:
+    """Given a list of new book datasets (in the same format as the ones given to clean_books), merge them into the
+    existing cleaned all_books data at file_save_name, and return every book in the new book datasets.
+    """
+    new_books = {}
+    for books_data_file in books_data_files:
+        new_books.update(clean_books(books_data_file))
+
+    append_update(new_books, file_save_name)
+    return new_books
+
+
+def update_genre(genre: str, review_files: list[str], books_data_files: list[str]) -> None:
+    """Given a genre, and its new review and book datasets, merge the new data into the genre's cleaned users_read and
+    all_books data, and then bring the genre's co-rated books index (if it has one) up to date with the new ratings.
+    Neither the existing cleaned data nor the index is read or rewritten in full: the new data is appended to the
+    cleaned data, and only the ratings and neighbour lists of the books the new ratings touch are read and rewritten in
+    the index's database. So this takes time proportional to the new data and to the number of ratings of those books
+    (apart from the occasional compaction, see append_update and book_index.update_index_file).
+
+    Preconditions:
+        - genre in ['comics_graphic', 'fantasy_paranormal', 'mystery_thriller_crime', 'romance', 'young_adult']
+    """
+    new_users = update_users(review_files, f'users_read/{genre}.json')
+    update_books(books_data_files, f'books/books_{genre}.json')
+
+    if len(new_users) > 0 and os.path.exists(f'book_index/{genre}.bin'):
+        bi.update_index_file(f'book_index/{genre}.bin', new_users)
+
+
+def compact_cleaned_data(filename: str) -> None:
+    """Given a valid filename representing cleaned users_read data or all_books data, fold every update that has been
+    appended to it back into the file itself, so that it can be read without merging the updates again.
+    """
+    dictionary = get_cleaned_data(filename)
+
+    with open(filename, 'w') as output_f:
+        json_str = json.dumps(dictionary, indent=4)
+        output_f.write(json_str)
+
+    if os.path.exists(f'{filename}.delta'):
+        os.remove(f'{filename}.delta')
+
+
+def get_genre(genre: str) -> tuple[bg.UsersReadDict, AllBooksDict]:
+    """Given a genre, retrieve both its users_read dictionary and its all_books dictionary, and return them as a tuple.
+    """
+    return (get_cleaned_data(f'users_read/{genre}.json'), get_cleaned_data(f'books/books_{genre}.json'))
+
+
+def get_cpu_count() -> int:
+    """Return the number of CPUs this process can use.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_genre_stamp(genre: str) -> list[tuple[str, int, int]]:
+    """Return the size and modification time of every cleaned data file (and its appended updates) of the given genre,
+    which changes whenever its data does.
+    """
+    stamp = []
+    for filename in [f'users_read/{genre}.json', f'books/books_{genre}.json']:
+        for path in [filename, f'{filename}.delta']:
+            if os.path.exists(path):
+                stamp.append((path, os.path.getsize(path), os.stat(path).st_mtime_ns))
+
+    return stamp
+
+
+def load_genre_cache(genre: str) -> tuple[bg.UsersReadDict, AllBooksDict] | None:
+    """Return the users_read and all_books dictionaries of the given genre from its cache in GENRE_CACHE_FOLDER, or
+    None if it was not cached since the genre's data last changed (or its cache cannot be read).
+    """
+    cache_file = f'{GENRE_CACHE_FOLDER}/{genre}.pickle'
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        with open(cache_file, 'rb') as f:
+            # the stamp is pickled on its own, ahead of the data, so that a stale cache is not loaded in full
+            if pickle.load(f) != get_genre_stamp(genre):
+                return None
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError, ValueError):
+        return None
+
+
+def save_genre_cache(genre: str, stamp: list[tuple[str, int, int]],
+                     data: tuple[bg.UsersReadDict, AllBooksDict]) -> None:
+    """Save the users_read and all_books dictionaries of the given genre, as they were when its data had the given
+    stamp (see get_genre_stamp), to its cache in GENRE_CACHE_FOLDER.
+    """
+    os.makedirs(GENRE_CACHE_FOLDER, exist_ok=True)
+
+    # write to a temporary file first, and then move it into place, so that the cache is never left half-written
+    fd, temp_file = tempfile.mkstemp(dir=GENRE_CACHE_FOLDER, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(stamp, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, f'{GENRE_CACHE_FOLDER}/{genre}.pickle')
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+
+def cache_genre(genre: str) -> tuple[bg.UsersReadDict, AllBooksDict]:
+    """Load the given genre from its cleaned data (see get_genre), save it to its cache, and return it.
+    """
+    # the stamp is taken first, so that the cache is stale if the data changes while it is being read
+    stamp = get_genre_stamp(genre)
+    data = get_genre(genre)
+    save_genre_cache(genre, stamp, data)
+    return data
+
+
+def build_genre_cache(genre: str) -> None:
+    """Cache the given genre without returning it, for the worker processes of get_genres.
+    """
+    cache_genre(genre)
 
 
 def get_genres(genres: list[str]) -> tuple[bg.UsersReadDict, AllBooksDict]:
     """Given a list of genres, retrieve both the users_read dictionary and all_books dictionary data corresponding
     to each genre, then return a tuple containing those two types of dictionaries, but merged for all genres
+
+    Each genre is loaded from its cache (see load_genre_cache) when it has one, and otherwise from its cleaned data,
+    which is then cached for next time. When several genres have to be loaded from their cleaned data and there is more
+    than one CPU to use, they are parsed and cached in separate processes, which only write the caches, so that this
+    process then loads them instead of unpickling the data sent back by each process.
     """
-    users_read_multiple = []
-    all_books_multiple = []
-    for genre in genres:
-        users_read_multiple.append(get_cleaned_data(f'users_read/{genre}.json'))
-        all_books_multiple.append(get_cleaned_data(f'books/books_{genre}.json'))
-    # merge the dictionaries
-    users_read = {}
-    all_books = {}
-
-    for i in range(0, len(users_read_multiple)):
-        # merge all the users_read datasets together
-        for u_id in users_read_multiple[i]:
+    genre_data = [load_genre_cache(genre) for genre in genres]
+    missing = [genres[i] for i in range(0, len(genres)) if genre_data[i] is None]
+
+    if len(missing) > 1 and get_cpu_count() > 1:
+        with ProcessPoolExecutor(max_workers=min(len(missing), get_cpu_count())) as executor:
+            list(executor.map(build_genre_cache, missing))
+
+    for i in range(0, len(genres)):
+        if genre_data[i] is None:
+            # the cache built by a worker can be missing, e.g. if the data changed since it was built
+            genre_data[i] = load_genre_cache(genres[i]) or cache_genre(genres[i])
+
+    # merge the other genres into the first one, instead of copying every genre into new dictionaries
+    users_read, all_books = genre_data[0] if len(genre_data) > 0 else ({}, {})
+
+    for users_read_genre, all_books_genre in genre_data[1:]:
+        # merge the users_read datasets together
+        for u_id in users_read_genre:
             if u_id not in users_read:  # we can set the read books dict directly
-                users_read[u_id] = users_read_multiple[i][u_id]
+                users_read[u_id] = users_read_genre[u_id]
             else:  # we must mutate the read books dict, as it already has information we don't want to overwrite
-                users_read[u_id].update(users_read_multiple[i][u_id])
+                users_read[u_id].update(users_read_genre[u_id])
 
         # the consequences of the books datasets overwriting is not important, because even if a book appears twice, in
         # two different genres, it still has the same metadata
-        all_books.update(all_books_multiple[i])
+        all_books.update(all_books_genre)
 
     print('Retrieved all books and users...')
     return (users_read, all_books)
@@ -118,8 +325,10 @@ if __name__ == '__main__':
     import python_ta
 
     python_ta.check_all(config={
-        'extra-imports': ['similar_books_graph', 'typing', 'json'],
-        'allowed-io': ['get_users', 'clean_books', 'get_cleaned_data', 'get_genres'],
+        'extra-imports': ['similar_books_graph', 'book_index', 'concurrent.futures', 'typing', 'json', 'os', 'pickle',
+                          'tempfile'],
+        'allowed-io': ['get_users', 'clean_books', 'get_cleaned_data', 'get_genres', 'append_update',
+                       'compact_cleaned_data', 'load_genre_cache', 'save_genre_cache'],
         'max-line-length': 120,
         'disable': ['E9992', 'E9997']
     })
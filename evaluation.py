@@ -0,0 +1,214 @@
+"""CSC111 Course Project:  Books On Books On Books
+
+===============================
+
+This module contains a collection of Python classes and functions for evaluating the recommending methods offline, by
+replaying the like/dislike loop of the GUI for many held-out users at once, using their real ratings as the client's
+feedback.
+
+Copyright and Usage Information
+===============================
+
+This file is Copyright (c) 2023 Ethan Chan, Ernest Yuen, Alyssa Lu, and Kelsie Fung.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+import os
+import random
+import tempfile
+import time
+import similar_books_graph as bg
+import book_selection as rb
+import book_index as bi
+import data_gen
+
+# the state of each worker process, set up once per process by init_worker so that every simulated session in that
+# process can share it
+WORKER_STATE: dict[str, Any] = {}
+
+
+class EvaluationReport:
+    """The results of simulating many sessions with one recommending method.
+
+    Instance Attributes:
+    - method:
+        The recommending method that was evaluated
+    - sessions:
+        The number of sessions that were simulated
+    - recommended:
+        The total number of books recommended over all sessions
+    - hits:
+        The total number of recommended books that the held-out user had rated well
+    - sessions_with_hit:
+        The number of sessions in which at least one recommended book was rated well by the held-out user
+    - seconds:
+        How long it took to simulate every session, in seconds
+
+    Representation Invariants:
+    - 0 <= self.hits <= self.recommended
+    - 0 <= self.sessions_with_hit <= self.sessions
+    """
+    method: str
+    sessions: int
+    recommended: int
+    hits: int
+    sessions_with_hit: int
+    seconds: float
+
+    def __init__(self, method: str, results: list[tuple[int, int]], seconds: float) -> None:
+        """Initialise an EvaluationReport from the (recommended, hits) results of each simulated session.
+        """
+        self.method = method
+        self.sessions = len(results)
+        self.recommended = sum(result[0] for result in results)
+        self.hits = sum(result[1] for result in results)
+        self.sessions_with_hit = sum(1 for result in results if result[1] > 0)
+        self.seconds = seconds
+
+    def __str__(self) -> str:
+        return (f'{self.method}: hit rate {self.hit_rate():.3f} ({self.hits}/{self.recommended} books), '
+                f'{self.sessions_with_hit}/{self.sessions} sessions with a hit, '
+                f'{self.sessions_per_second():.2f} sessions/s')
+
+    def hit_rate(self) -> float:
+        """Return the fraction of recommended books that the held-out users had rated well.
+        """
+        if self.recommended == 0:
+            return 0.0
+        return self.hits / self.recommended
+
+    def sessions_per_second(self) -> float:
+        """Return how many sessions were simulated per second.
+        """
+        if self.seconds == 0:
+            return 0.0
+        return self.sessions / self.seconds
+
+
+def get_held_out_users(users_read: bg.UsersReadDict, n: int, min_good_ratings: int = 5,
+                       seed: int = 0) -> list[bg.UserID]:
+    """Return a random sample of n users (or all of them, if there are fewer) with at least min_good_ratings good
+    ratings, to be used as the simulated clients. The same seed always gives the same sample.
+    """
+    candidates = [u_id for u_id in users_read
+                  if sum(1 for rating in users_read[u_id].values() if rating >= bg.GOOD_RATING) >= min_good_ratings]
+
+    if n >= len(candidates):
+        return candidates
+    return random.Random(seed).sample(candidates, n)
+
+
+def init_worker(genres: list[str], training: tuple[bg.UsersReadDict, data_gen.AllBooksDict],
+                held_out: bg.UsersReadDict, index_file: str | None) -> None:
+    """Set up the state shared by every session simulated in this process: the ratings of the held-out users, the
+    co-rated books index in index_file (if there is one), and a RunBookNetwork of every training user (that is, every
+    user except the held-out ones), which is built once here and then rolled back to its initial state after each
+    session (see BookNetwork.checkpoint).
+    """
+    indexes = [] if index_file is None else [bi.BookIndex(index_file)]
+    rbn = rb.RunBookNetwork(genres, training, indexes)
+    rbn.book_network.checkpoint()
+
+    WORKER_STATE['held_out'] = held_out
+    WORKER_STATE['rbn'] = rbn
+
+
+def simulate_session(u_id: bg.UserID, method: str, rounds: int = 10) -> tuple[int, int]:
+    """Simulate a session of the held-out user u_id with the given recommending method, and return a tuple containing
+    the number of books recommended, and the number of those that the user had rated well.
+
+    For each round, books are recommended to the user, which they like if they had rated them well and dislike if they
+    had rated them badly (books they had not read get no feedback), and the network is pruned accordingly, just like in
+    the GUI. The session ends early if the network has no new books left to recommend.
+
+    The session is run on the process's shared RunBookNetwork, which is rolled back afterwards.
+
+    Preconditions:
+        - init_worker has been called in this process
+        - u_id in WORKER_STATE['held_out']
+        - method in ['rating', 'popularity', 'random', 'similar']
+    """
+    ratings = WORKER_STATE['held_out'][u_id]
+    rbn = WORKER_STATE['rbn']
+    rbn.liked_books = []
+    rbn.disliked_books = []
+
+    # seed by user, so that a session with the random method is the same whichever process it runs in
+    random.seed(u_id)
+
+    recommended = 0
+    hits = 0
+    seen = set()
+    try:
+        for _ in range(0, rounds):
+            book_ids = [b_id for b_id in rbn.get_recommended_books(method) if b_id not in seen]
+            # when the network runs out of books, it starts recommending the same ones again
+            if len(book_ids) == 0:
+                break
+            seen.update(book_ids)
+
+            liked = [b_id for b_id in book_ids if ratings.get(b_id, 0) >= bg.GOOD_RATING]
+            disliked = [b_id for b_id in book_ids if b_id in ratings and b_id not in liked]
+            rbn.record_feedback(liked, disliked)
+
+            recommended += len(book_ids)
+            hits += len(liked)
+    finally:
+        # the next session in this process must start from the initial network, even if this one failed
+        rbn.book_network.rollback()
+
+    return (recommended, hits)
+
+
+def evaluate(genres: list[str], method: str, n_sessions: int = 1000, rounds: int = 10,
+             processes: int | None = None, seed: int = 0) -> EvaluationReport:
+    """Load the data of the given genres once, then simulate n_sessions sessions (see simulate_session) of held-out
+    users with the given recommending method, split between processes worker processes (by default, one per CPU).
+    Return a report of the hit rate and throughput of the sessions.
+
+    Every method is run on the same training data: the network (and, for the 'similar' method, the co-rated books
+    index) is built from every user except the held-out ones, so that their ratings cannot leak into their own
+    recommendations, and the hit rates of the methods can be compared.
+
+    Preconditions:
+        - all(genre in ['comics_graphic', 'fantasy_paranormal', 'mystery_thriller_crime',
+              'romance', 'young_adult'] for genre in genres)
+        - method in ['rating', 'popularity', 'random', 'similar']
+    """
+    users_read, all_books = data_gen.get_genres(genres)
+    held_out = get_held_out_users(users_read, n_sessions, seed=seed)
+
+    held_out_ratings = {u_id: users_read[u_id] for u_id in held_out}
+    training = {u_id: users_read[u_id] for u_id in users_read if u_id not in held_out_ratings}
+
+    with tempfile.TemporaryDirectory() as index_folder:
+        index_file = None
+        if method == 'similar':
+            index_file = f'{index_folder}/evaluation.bin'
+            bi.save_index(bi.build_index(training), index_file)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                 initargs=(genres, (training, all_books), held_out_ratings, index_file)) as executor:
+            # chunk the sessions, so that each process gets a batch of them at a time rather than one by one
+            chunksize = max(1, len(held_out) // (4 * (processes or os.cpu_count() or 1)))
+            results = list(executor.map(simulate_session, held_out, [method] * len(held_out),
+                                        [rounds] * len(held_out), chunksize=chunksize))
+        seconds = time.perf_counter() - start
+
+    return EvaluationReport(method, results, seconds)
+
+
+if __name__ == '__main__':
+    for recommending_method in ['random', 'rating', 'popularity', 'similar']:
+        print(evaluate(['comics_graphic'], recommending_method, n_sessions=200))
+
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['similar_books_graph', 'book_selection', 'book_index', 'data_gen', 'concurrent.futures',
+                          'typing', 'os', 'random', 'tempfile', 'time'],
+        'allowed-io': ['evaluate'],
+        'max-line-length': 120,
+        'disable': ['E9992', 'E9997']
+    })
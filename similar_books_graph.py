@@ -11,6 +11,7 @@ This file is Copyright (c) 2023 Ethan Chan, Ernest Yuen, Alyssa Lu, and Kelsie F
 """
 from __future__ import annotations
 from typing import Callable
+import heapq
 import random
 
 # what we define as a good rating
@@ -75,27 +76,77 @@ class BookNetwork:
     - used:
         A set of the IDs of the books that have already been given to the user. We would not like to repeat the books
         we show the user, as that would make the development of the network much slower.
+    - min_degree:
+        The compaction policy's minimum number of users a book must be connected to in order to stay in the network.
+        Books with fewer users (e.g. the ones left with none after their users were pruned) are evicted by compact().
+    - max_books:
+        The compaction policy's budget on the number of books kept in the network (as a stand-in for its memory use),
+        or None for no budget. compact() evicts the least connected books past this budget.
+    - compact_every:
+        How many calls to prune() there are between each compaction: 1 compacts eagerly after every prune, and larger
+        values compact in periodic batches. 0 never compacts automatically.
+    - low_degree:
+        The IDs of the books that have fallen below min_degree since the last compaction
+    - prunes_since_compact:
+        The number of calls to prune() since the last compaction
+    - copied_books:
+        The number of books in the network when self.books was last built or copied by compact()
+    - copied_users:
+        The number of users in the network when self.users was last built or copied by compact()
+    - journal:
+        The nodes disconnected since the last call to checkpoint(), in order, or None if there is no checkpoint
+    - saved_ratings:
+        The rating each book had at the last checkpoint, for the books whose rating changed since then
+    - base_state:
+        The rest of the state of the network at the last checkpoint (its users, books, used books, and compaction
+        bookkeeping), or None if there is no checkpoint
 
     Representation Invariants:
     - all(i == i.obj_id for i in self.users)
     - all(j == j.obj_id for j in self.books)
+    - self.min_degree >= 0
+    - self.max_books is None or self.max_books >= 0
+    - self.compact_every >= 0
     """
     users: dict[BookID, Node]
     books: dict[BookID, Node]
     users_read: dict[UserID, dict[BookID, float | int]]
     used: set[BookID]
-
-    def __init__(self, similar: list[UserID], users_read: UsersReadDict) -> None:
+    min_degree: int
+    max_books: int | None
+    compact_every: int
+    low_degree: set[BookID]
+    prunes_since_compact: int
+    copied_books: int
+    copied_users: int
+    journal: list[Node] | None
+    saved_ratings: dict[BookID, float]
+    base_state: tuple | None
+
+    def __init__(self, similar: list[UserID], users_read: UsersReadDict, min_degree: int = 1,
+                 max_books: int | None = None, compact_every: int = 1) -> None:
         """Initialise a BookNetwork made of the users listed in similar, or if similar is empty, initialise a
-        BookNetwork containing every user in the 'reviews' dataset.
+        BookNetwork containing every user in the 'reviews' dataset. The network is compacted right away according
+        to the given policy (see the min_degree, max_books and compact_every instance attributes).
 
         Preconditions:
             - all(user in users_read for user in self.similar)
+            - min_degree >= 0
+            - max_books is None or max_books >= 0
+            - compact_every >= 0
         """
         self.users = {}
         self.books = {}
         self.users_read = users_read
         self.used = set()
+        self.min_degree = min_degree
+        self.max_books = max_books
+        self.compact_every = compact_every
+        self.low_degree = set()
+        self.prunes_since_compact = 0
+        self.journal = None
+        self.saved_ratings = {}
+        self.base_state = None
 
         # for each user in the list of similar users, we generate their Node
         for u_id in similar:
@@ -128,9 +179,51 @@ class BookNetwork:
                     # set the rating of the book node to the rating this user has given it
                     book_node.rating = self.users_read[u_id][book_id]
 
+        self.copied_books = len(self.books)
+        self.copied_users = len(self.users)
+
+        # books with too few ratings to begin with are evicted as well
+        self.low_degree = {b_id for b_id in self.books if len(self.books[b_id].connected) < self.min_degree}
+        if self.low_degree or (self.max_books is not None and len(self.books) > self.max_books):
+            self.compact()
+
     def __str__(self) -> str:
         return f'Books: {self.books}\nUsers: {self.users}'
 
+    def __getstate__(self) -> dict:
+        """Return the state of this network to be pickled. Pickling the nodes themselves would recurse through the whole
+        network, so each user is stored as its ID and the IDs of the books it is connected to, and each book as its ID
+        and rating, and the nodes are rebuilt from these by __setstate__.
+
+        A checkpoint refers to nodes that are no longer in the network, so it is not kept: the unpickled network has no
+        checkpoint to roll back to.
+        """
+        state = self.__dict__.copy()
+        state['users'] = [(u_id, list(self.users[u_id].connected)) for u_id in self.users]
+        state['books'] = [(b_id, self.books[b_id].rating) for b_id in self.books]
+        state['journal'] = None
+        state['saved_ratings'] = {}
+        state['base_state'] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """Restore this network from the state returned by __getstate__, rebuilding its nodes and their connections.
+        """
+        books = {}
+        for b_id, rating in state['books']:
+            books[b_id] = Node(False, b_id)
+            books[b_id].rating = rating
+
+        users = {}
+        for u_id, book_ids in state['users']:
+            users[u_id] = Node(True, u_id)
+            for b_id in book_ids:
+                users[u_id].connect(books[b_id])
+
+        state['users'] = users
+        state['books'] = books
+        self.__dict__.update(state)
+
     def get_books_by_statistic(self, metric: Callable, n: int = 3) -> list[BookID]:
         """Select the books in BookNetwork that return the highest metrics based on some statistic (popularity, or
         rating), and return a list of them (to the client for them to evaluate, so our book network may evolve to
@@ -185,7 +278,7 @@ class BookNetwork:
         recommended = []
         i = 0
         while i < n:
-            choice = random.randint(0, len(book_id_lst))
+            choice = random.randint(0, len(book_id_lst) - 1)
             # account for duplicates and already used books
             if book_id_lst[choice] not in self.used:
                 recommended.append(book_id_lst[choice])
@@ -213,12 +306,73 @@ class BookNetwork:
                     self.disconnect(self.users[u_id])
                     break
 
+        # compact the network, if this is the prune the policy asks for
+        self.prunes_since_compact += 1
+        if self.compact_every > 0 and self.prunes_since_compact >= self.compact_every:
+            self.compact()
+
         return dissimilar
 
+    def compact(self) -> list[BookID]:
+        """Evict the books that do not meet the compaction policy from the network, and return a list of their IDs.
+
+        First, every book connected to fewer than min_degree users is evicted. Then, if there are still more than
+        max_books books, the least connected books are evicted until the network is within its budget. Users left
+        without any books are removed along with them (see disconnect).
+
+        A book whose only user is pruned is evicted by the compaction that follows:
+        >>> users_read = {'u1': {'a': 5, 'b': 4}, 'u2': {'a': 2, 'c': 5}, 'u3': {'c': 4}}
+        >>> network = BookNetwork(['u1', 'u2', 'u3'], users_read)
+        >>> network.prune(['b'])
+        ['u1']
+        >>> sorted(network.books)
+        ['a', 'c']
+
+        With a budget of max_books, the least connected books are evicted first:
+        >>> network = BookNetwork(['u1', 'u2', 'u3'], users_read, max_books=2)
+        >>> sorted(network.books)
+        ['a', 'c']
+        >>> sorted(network.users['u1'].connected)
+        ['a']
+        """
+        self.prunes_since_compact = 0
+
+        # only the books that lost users since the last compaction can have fallen below min_degree
+        evicted = [b_id for b_id in self.low_degree
+                   if b_id in self.books and len(self.books[b_id].connected) < self.min_degree]
+        self.low_degree = set()
+        for b_id in evicted:
+            self.disconnect(self.books[b_id])
+
+        if self.max_books is not None and len(self.books) > self.max_books:
+            over_budget = heapq.nsmallest(len(self.books) - self.max_books, self.books.values(),
+                                          key=lambda book: len(book.connected))
+            for book in over_budget:
+                evicted.append(book.obj_id)
+                self.disconnect(book)
+
+        # evicted books no longer count towards the books that were already recommended
+        self.used.difference_update(evicted)
+
+        # a dictionary never shrinks when items are deleted from it, so copy the rest into a smaller one, but only once
+        # at least half of it has been deleted, so that the copies do not cost more than the deletions themselves
+        if len(self.books) < self.copied_books // 2:
+            self.books = dict(self.books)
+            self.copied_books = len(self.books)
+        if len(self.users) < self.copied_users // 2:
+            self.users = dict(self.users)
+            self.copied_users = len(self.users)
+
+        return evicted
+
     def disconnect(self, node: Node) -> None:
         """Given a node within this network, disconnect it by removing it from the dictionary of books/users, as well
         as removing it from the '.connected' attribute of each of its neighbours.
         """
+        # remember the node, so that it can be reconnected by rollback()
+        if self.journal is not None:
+            self.journal.append(node)
+
         # removing a user node means updating the rating of the neighbouring book nodes
         if node.is_user:
             u_id = node.obj_id
@@ -227,7 +381,9 @@ class BookNetwork:
                 # get the connections of the book
                 book = node.connected[book_id]
 
-                # update rating
+                # update rating, after saving the rating it had at the checkpoint (if there is one)
+                if self.journal is not None and book_id not in self.saved_ratings:
+                    self.saved_ratings[book_id] = book.rating
                 n = len(book.connected)
                 user_rating = self.users_read[u_id][book_id]
                 # we should only update the average if there is more than 1 user, as if there is only 1 user, then
@@ -240,6 +396,10 @@ class BookNetwork:
                 # remove its connection to this node
                 del book.connected[u_id]
 
+                # leave the book to be evicted by the next compaction, if it no longer has enough users
+                if len(book.connected) < self.min_degree:
+                    self.low_degree.add(book_id)
+
             # remove the user from the graph
             del self.users[u_id]
 
@@ -260,6 +420,57 @@ class BookNetwork:
             # remove the book from the graph
             del self.books[b_id]
 
+    def checkpoint(self) -> None:
+        """Save the current state of this network, and start recording the changes made to it from now on, so that
+        they can be undone with rollback().
+
+        This lets the same network be reused for many sessions (e.g. in evaluation.py) without building it again.
+        """
+        self.base_state = (dict(self.users), dict(self.books), set(self.used), set(self.low_degree),
+                           self.prunes_since_compact, self.copied_books, self.copied_users)
+        self.journal = []
+        self.saved_ratings = {}
+
+    def rollback(self) -> None:
+        """Undo every change made to this network since the last call to checkpoint(), taking time proportional to the
+        changes (plus copying the users and books dictionaries of the checkpoint).
+
+        Disconnecting a node leaves its own connected dictionary as is (only its neighbours forget it), so each node
+        can be reconnected by going through the disconnected nodes in reverse order.
+
+        >>> users_read = {'u1': {'a': 5, 'b': 4}, 'u2': {'a': 2, 'c': 5}, 'u3': {'c': 4}}
+        >>> network = BookNetwork(['u1', 'u2', 'u3'], users_read)
+        >>> network.checkpoint()
+        >>> network.prune(['b'])
+        ['u1']
+        >>> sorted(network.users), sorted(network.books), network.books['a'].rating
+        (['u2', 'u3'], ['a', 'c'], 2.0)
+        >>> network.rollback()
+        >>> sorted(network.users), sorted(network.books), network.books['a'].rating
+        (['u1', 'u2', 'u3'], ['a', 'b', 'c'], 3.5)
+        >>> sorted(network.users['u1'].connected), sorted(network.books['b'].connected)
+        (['a', 'b'], ['u1'])
+
+        Preconditions:
+            - self.base_state is not None
+        """
+        for node in reversed(self.journal):
+            for neighbour in node.connected.values():
+                neighbour.connected[node.obj_id] = node
+
+        users, books, used, low_degree, self.prunes_since_compact, self.copied_books, self.copied_users = \
+            self.base_state
+        for book_id in self.saved_ratings:
+            books[book_id].rating = self.saved_ratings[book_id]
+
+        # copy the checkpoint's dictionaries, so that they are kept as they were for the next rollback
+        self.users = dict(users)
+        self.books = dict(books)
+        self.used = set(used)
+        self.low_degree = set(low_degree)
+        self.journal = []
+        self.saved_ratings = {}
+
 
 if __name__ == '__main__':
     import doctest
@@ -268,7 +479,7 @@ if __name__ == '__main__':
     import python_ta
 
     python_ta.check_all(config={
-        'extra-imports': ['__future__', 'typing', 'random'],
+        'extra-imports': ['__future__', 'typing', 'heapq', 'random'],
         'max-line-length': 120,
         'disable': ['E9992', 'E9997']
     })